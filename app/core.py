@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 
-import base64, io, json
+import csv, io, json, math, os, shutil
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, partial
 from pathlib import Path
 
 def _progress(iterable, total=None, desc=""):
@@ -11,10 +15,62 @@ def _progress(iterable, total=None, desc=""):
         return iterable
 
 try:
+    import PIL
     from PIL import Image, ImageOps
     PIL_OK = True
+    # Pillow-SIMD publishes ".postN" versions; its resize kernels use SSE4/AVX2
+    PIL_SIMD = ".post" in PIL.__version__
 except Exception:
     PIL_OK = False
+    PIL_SIMD = False
+
+# libjpeg-turbo (SIMD) codec; falls back to Pillow's encoder/decoder if the library can't be loaded
+try:
+    import numpy as np
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420, TJFLAG_PROGRESSIVE
+    _TJ = TurboJPEG()
+    _ORIENTATION = {
+        2: Image.Transpose.FLIP_LEFT_RIGHT,
+        3: Image.Transpose.ROTATE_180,
+        4: Image.Transpose.FLIP_TOP_BOTTOM,
+        5: Image.Transpose.TRANSPOSE,
+        6: Image.Transpose.ROTATE_270,
+        7: Image.Transpose.TRANSVERSE,
+        8: Image.Transpose.ROTATE_90,
+    }
+except Exception:
+    _TJ = None
+
+# OpenCV's libjpeg-turbo encoder, used when PyTurboJPEG is unavailable
+try:
+    import cv2
+    import numpy as np
+except Exception:
+    cv2 = None
+
+# SIMD (AVX2/SSSE3) base64 encoder; same API as the stdlib one
+try:
+    from pybase64 import b64encode
+except Exception:
+    from base64 import b64encode
+
+# fast non-cryptographic hash for duplicate detection; blake2b fallback
+try:
+    import xxhash
+    _digest = xxhash.xxh3_64_hexdigest
+except Exception:
+    import hashlib
+    def _digest(data: bytes) -> str:
+        return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+DATA_URI_PREFIX = b"data:image/jpeg;base64,"
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png")
+MANIFEST_FIELDS = ["source", "output", "orig_bytes", "final_jpeg_bytes", "base64_chars", "data_uri"]
 
 def human(n):
     units = ["B","KB","MB","GB"]
@@ -27,63 +83,321 @@ def human(n):
 def ensure_dir(p: Path):
     p.mkdir(parents=True, exist_ok=True)
 
-def jpeg_fit_to_b64_cap(jpeg_bytes: bytes, cap_chars: int, max_px: int = 800, quality_floor: int = 50):
+# start-of-frame markers safe to hand to browsers as-is: baseline,
+# extended sequential and progressive Huffman (SOF0-SOF2)
+_SOF_MARKERS = frozenset({0xC0, 0xC1, 0xC2})
+
+def _exif_orientation(tiff: bytes) -> int:
+    if tiff[:2] not in (b"II", b"MM"):
+        return 1
+    order = "little" if tiff[:2] == b"II" else "big"
+    ifd = int.from_bytes(tiff[4:8], order)
+    for k in range(int.from_bytes(tiff[ifd:ifd + 2], order)):
+        e = ifd + 2 + 12 * k
+        if int.from_bytes(tiff[e:e + 2], order) == 0x0112:
+            return int.from_bytes(tiff[e + 8:e + 10], order)
+    return 1
+
+def _jpeg_header(data: bytes):
+    # (width, height, orientation) read from the JPEG markers without decoding;
+    # None if this isn't a complete, plain grayscale/YCbCr JPEG we can pass through
+    if data[:2] != b"\xff\xd8" or not data.rstrip(b"\x00\r\n ").endswith(b"\xff\xd9"):
+        return None
+    orientation = 1
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        seg_len = int.from_bytes(data[i + 2:i + 4], "big")
+        if marker == 0xE1 and data[i + 4:i + 10] == b"Exif\0\0":
+            orientation = _exif_orientation(data[i + 10:i + 2 + seg_len])
+        elif 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            # 8-bit samples only; 12-bit frames decode nowhere a browser would
+            if (marker not in _SOF_MARKERS or data[i + 4:i + 5] != b"\x08"
+                    or data[i + 9:i + 10] not in (b"\x01", b"\x03")):
+                return None
+            h = int.from_bytes(data[i + 5:i + 7], "big")
+            w = int.from_bytes(data[i + 7:i + 9], "big")
+            return w, h, orientation
+        elif marker == 0xDA:
+            return None
+        i += 2 + seg_len
+    return None
+
+def _tj_scaling_factor(w: int, h: int, max_px: int):
+    # smallest libjpeg-turbo DCT scaling factor that keeps the long side >= max_px
+    long_side = max(w, h)
+    fits = [(n, d) for n, d in _TJ.scaling_factors if n <= d and long_side * n >= max_px * d]
+    return min(fits, key=lambda f: f[0] / f[1], default=(1, 1))
+
+def _decode(jpeg_bytes: bytes, max_px: int):
+    src = Image.open(io.BytesIO(jpeg_bytes))
+    if _TJ is None or src.format != "JPEG" or src.mode == "CMYK":
+        # let libjpeg scale by 1/2, 1/4 or 1/8 during the IDCT for large
+        # sources; the LANCZOS resize afterwards only polishes the result
+        src.draft("RGB", (max_px, max_px))
+        return ImageOps.exif_transpose(src).convert("RGB")
+
+    # only the header was parsed by Pillow; pixels come from libjpeg-turbo
+    im = Image.fromarray(_TJ.decode(jpeg_bytes, pixel_format=TJPF_RGB,
+                                    scaling_factor=_tj_scaling_factor(*src.size, max_px)))
+    method = _ORIENTATION.get(src.getexif().get(0x0112, 1))
+    return im.transpose(method) if method is not None else im
+
+def _cv2_encode(bgr, q: int, final: bool = False):
+    flag = 1 if final else 0
+    ok, enc = cv2.imencode(".jpg", bgr, [
+        cv2.IMWRITE_JPEG_QUALITY, q,
+        cv2.IMWRITE_JPEG_OPTIMIZE, flag,
+        cv2.IMWRITE_JPEG_PROGRESSIVE, flag,
+    ])
+    if not ok:
+        raise ValueError("OpenCV failed to encode JPEG")
+    return enc
+
+def _search_quality(probe, max_bytes: int, q_lo: int, q_hi: int):
+    # (highest quality in [q_lo, q_hi] whose probed size fits max_bytes or None,
+    # last probed size); when nothing fits, the last probe was q_lo itself
+    fit, size = None, None
+    while q_lo <= q_hi:
+        q_mid = (q_lo + q_hi) // 2
+        size = probe(q_mid)
+        if size <= max_bytes:
+            fit = q_mid
+            q_lo = q_mid + 1
+        else:
+            q_hi = q_mid - 1
+    return fit, size
+
+@lru_cache(maxsize=32)
+def make_shrinker(cap_chars: int, max_px: int = 800, quality_floor: int = 50):
+    # per-settings shrink(jpeg_bytes) -> (bytes, meta); cached so a batch (and
+    # each worker process) builds it once for its (cap_chars, max_px, quality_floor)
     if not PIL_OK:
-        return jpeg_bytes, {"note":"Pillow not installed; no resizing/compression performed."}
-    from PIL import Image, ImageOps
-    import io
+        def shrink(jpeg_bytes: bytes):
+            return jpeg_bytes, {"note":"Pillow not installed; no resizing/compression performed."}
+        return shrink
 
     max_bytes = (cap_chars * 3) // 4
 
-    im = Image.open(io.BytesIO(jpeg_bytes))
-    im = ImageOps.exif_transpose(im).convert("RGB")
+    def shrink(jpeg_bytes: bytes):
+        # already small enough: pass the source through without a decode/encode round-trip
+        if len(jpeg_bytes) <= max_bytes:
+            header = _jpeg_header(jpeg_bytes)
+            if header is not None:
+                w, h, orientation = header
+                if max(w, h) <= max_px and orientation in (0, 1):
+                    return jpeg_bytes, {
+                        "final_dims": (w, h),
+                        "jpeg_bytes": len(jpeg_bytes),
+                        "base64_chars": 4 * ((len(jpeg_bytes) + 2) // 3)
+                    }
 
-    w, h = im.size
-    if max(w, h) > max_px:
-        if w >= h:
-            new_w = max_px
-            new_h = int(h * (max_px / w))
-        else:
-            new_h = max_px
-            new_w = int(w * (max_px / h))
-        im = im.resize((new_w, new_h), Image.LANCZOS)
-
-    def encode(q: int) -> bytes:
-        buf = io.BytesIO()
-        im.save(buf, format="JPEG", quality=q, optimize=True, progressive=True, subsampling="4:2:0")
-        return buf.getvalue()
-
-    q_hi = 85
-    data = encode(q_hi)
-
-    if len(data) > max_bytes:
-        q_lo = quality_floor
-        while q_lo < q_hi:
-            q_mid = (q_lo + q_hi) // 2
-            buf = encode(q_mid)
-            if len(buf) <= max_bytes:
-                data = buf
-                q_hi = q_mid
+        im = _decode(jpeg_bytes, max_px)
+
+        w, h = im.size
+        if max(w, h) > max_px:
+            if w >= h:
+                new_w = max_px
+                new_h = int(h * (max_px / w))
             else:
-                q_lo = q_mid + 1
+                new_h = max_px
+                new_w = int(w * (max_px / h))
+            im = im.resize((new_w, new_h), Image.LANCZOS)
+
+        # codec-side pixel buffer (RGB for libjpeg-turbo, BGR for OpenCV) and, for
+        # libjpeg-turbo, a reusable output buffer; refreshed only when im is resized
+        def load(img):
+            if _TJ is not None:
+                a = np.asarray(img)
+                return a, bytearray(_TJ.buffer_size(a, TJSAMP_420))
+            if cv2 is not None:
+                return cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2BGR), None
+            return None, None
+
+        arr, scratch = load(im)
+
+        # search probes skip Huffman optimization and progressive scans; only the
+        # chosen quality is re-encoded with them (final=True)
+        def encode(q: int, final: bool = False) -> bytes:
+            if _TJ is not None:
+                return _TJ.encode(arr, quality=q, pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420,
+                                  flags=TJFLAG_PROGRESSIVE if final else 0)
+            if cv2 is not None:
+                return _cv2_encode(arr, q, final).tobytes()
+            buf = io.BytesIO()
+            im.save(buf, format="JPEG", quality=q, optimize=final, progressive=final, subsampling="4:2:0")
+            return buf.getvalue()
+
+        # probes only need a size: libjpeg-turbo compresses into the same scratch
+        # buffer each time, and OpenCV's ndarray result is never copied out
+        def probe(q: int) -> int:
+            if _TJ is not None:
+                return _TJ.encode(arr, quality=q, pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420,
+                                  dst=scratch)[1]
+            if cv2 is not None:
+                return _cv2_encode(arr, q).size
+            return len(encode(q))
+
+        q = 85
+        data = encode(q, final=True)
 
         if len(data) > max_bytes:
-            attempts = 0
-            while len(data) > max_bytes and max(im.size) > 50 and attempts < 6:
-                w, h = im.size
-                im = im.resize((max(1, int(w*0.85)), max(1, int(h*0.85))), Image.LANCZOS)
-                data = encode(quality_floor)
-                attempts += 1
-
-    meta = {
-        "final_dims": im.size,
-        "jpeg_bytes": len(data),
-        "base64_chars": 4 * ((len(data) + 2) // 3)
-    }
-    return data, meta
+            q, size = _search_quality(probe, max_bytes, quality_floor, q - 1)
+
+            if q is None:
+                # even quality_floor was too big at this size
+                # JPEG size scales roughly with pixel count, so estimate the linear
+                # ratio up-front and resize once, with at most one 0.85 follow-up
+                q = quality_floor
+                if size is None:  # empty search range (quality_floor above 84)
+                    size = probe(q)
+                ratio = max(0.35, math.sqrt(max_bytes / max(1, size))) * 0.95
+                for _ in range(2):
+                    if size <= max_bytes or max(im.size) <= 50:
+                        break
+                    w, h = im.size
+                    im = im.resize((max(1, int(w*ratio)), max(1, int(h*ratio))), Image.LANCZOS)
+                    arr, scratch = load(im)
+                    size = probe(q)
+                    ratio = 0.85
+
+            # bytes are materialized once, for the chosen quality only
+            data = encode(q, final=True)
+            if len(data) > max_bytes:
+                baseline = encode(q)
+                if len(baseline) < len(data):
+                    data = baseline
+
+        meta = {
+            "final_dims": im.size,
+            "jpeg_bytes": len(data),
+            "base64_chars": 4 * ((len(data) + 2) // 3)
+        }
+        return data, meta
+
+    return shrink
+
+def jpeg_fit_to_b64_cap(jpeg_bytes: bytes, cap_chars: int, max_px: int = 800, quality_floor: int = 50):
+    return make_shrinker(cap_chars, max_px, quality_floor)(jpeg_bytes)
+
+def _walk(root: Path, recurse: bool):
+    # one scandir pass over the tree, matching extensions case-insensitively
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        with os.scandir(d) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    if recurse:
+                        stack.append(e.path)
+                elif e.name.lower().endswith(IMAGE_SUFFIXES):
+                    yield Path(e.path)
+
+def _write_json(path: Path, rows: list):
+    if orjson is not None:
+        path.write_bytes(orjson.dumps(rows, option=orjson.OPT_INDENT_2))
+    else:
+        path.write_text(json.dumps(rows, indent=2), encoding="utf-8")
+
+def _write_csv(path: Path, rows: list):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=MANIFEST_FIELDS)
+        w.writeheader()
+        w.writerows(rows)
+
+def _rel(item, input_dir: Path | None) -> Path:
+    return item.relative_to(input_dir) if isinstance(item, Path) else Path(item[0])
+
+_POOL = None
+
+def _pool() -> ProcessPoolExecutor:
+    # one pool per process, created on first use and reused across batches;
+    # workers are not forked from a (possibly threaded) server process
+    global _POOL
+    if _POOL is None:
+        method = "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"
+        _POOL = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=mp.get_context(method))
+    return _POOL
+
+def _reset_pool():
+    global _POOL
+    if _POOL is not None:
+        _POOL.shutdown(wait=False, cancel_futures=True)
+        _POOL = None
+
+def _dedupe(files: list):
+    # indices of items to encode, plus {duplicate index: first index} for
+    # in-memory items with identical bytes (path items are never hashed here)
+    unique, dup_of, seen = [], {}, {}
+    for i, item in enumerate(files):
+        if not isinstance(item, Path):
+            data = item[1]
+            key = _digest(data)
+            first = seen.get(key)
+            if first is not None and files[first][1] == data:
+                dup_of[i] = first
+                continue
+            seen.setdefault(key, i)
+        unique.append(i)
+    return unique, dup_of
+
+def _process_one(
+    item,
+    input_dir: Path | None,
+    output_dir: Path,
+    cap_chars: int | None,
+    data_uri: bool,
+    max_px: int,
+    quality_floor: int,
+):
+    # runs in a worker process; item is a Path under input_dir or an in-memory
+    # (relative name, bytes) pair; returns (manifest row, None) or (None, warning)
+    if isinstance(item, Path):
+        label = item
+    else:
+        label, b = item
+    try:
+        rel = _rel(item, input_dir)
+        if isinstance(item, Path):
+            b = item.read_bytes()
+        original_len = len(b)
+
+        if cap_chars is not None:
+            b, meta = make_shrinker(cap_chars, max_px, quality_floor)(b)
+
+        # base64 is ASCII (== UTF-8), so write the encoded bytes as-is
+        b64_len = 4 * ((len(b) + 2) // 3) + (len(DATA_URI_PREFIX) if data_uri else 0)
+
+        # parent dirs were created up-front by run_batch; writelines keeps the
+        # data URI prefix and payload as separate buffers (no concatenated copy)
+        out_file = output_dir / rel.with_suffix(".b64.txt")
+        with open(out_file, "wb") as f:
+            if data_uri:
+                f.writelines((DATA_URI_PREFIX, b64encode(b)))
+            else:
+                f.write(b64encode(b))
+
+        return {
+            "source": str(rel),
+            "output": str(out_file.relative_to(output_dir)),
+            "orig_bytes": original_len,
+            "final_jpeg_bytes": len(b),
+            "base64_chars": b64_len,
+            "data_uri": data_uri,
+        }, None
+    except Exception as e:
+        return None, f"[WARN] {label}: {e}"
 
 def run_batch(
-    input_dir: Path,
+    input_dir: Path | None,
     output_dir: Path,
     recurse: bool,
     data_uri: bool,
@@ -91,84 +405,104 @@ def run_batch(
     csv_map: bool,
     max_px: int,
     quality_floor: int,
-    log=print
+    log=print,
+    inputs: list[tuple[str, bytes]] | None = None,
 ):
-    patterns = ["*.jpg", "*.jpeg", "*.JPG", "*.JPEG", "*.png", "*.PNG"]
-    files = []
-    for pat in patterns:
-        files += list(input_dir.rglob(pat) if recurse else input_dir.glob(pat))
+    # inputs: already-in-memory (relative name, bytes) pairs, e.g. HTTP uploads;
+    # when given, input_dir/recurse are ignored and nothing is read from disk
+    if inputs is not None:
+        files = list(inputs)
+    else:
+        files = list(_walk(input_dir, recurse))
 
     if not files:
         log("No JPG/JPEG files found.")
         return 1
 
-    ensure_dir(output_dir)
-    out_map = []
-
     total_in = 0
     total_out_b64chars = 0
     skipped = 0
 
-    for p in _progress(files, total=len(files), desc="Encoding"):
-        try:
-            b = p.read_bytes()
-            original_len = len(b)
-
-            if cap_chars is not None:
-                def shrink(bytes_in):
-                    jb, meta = jpeg_fit_to_b64_cap(
-                        bytes_in,
-                        cap_chars,
-                        max_px=max_px,
-                        quality_floor=quality_floor
-                    )
-                    return jb, meta
-                b, meta = shrink(b)
-            else:
-                meta = {"final_dims": None, "jpeg_bytes": len(b)}
-
-            b64 = base64.b64encode(b).decode("ascii")
-            b64_full = f"data:image/jpeg;base64,{b64}" if data_uri else b64
-
-            rel = p.relative_to(input_dir)
-            out_file = output_dir / rel.with_suffix(".b64.txt")
-            ensure_dir(out_file.parent)
-            out_file.write_text(b64_full, encoding="utf-8")
-
-            total_in += original_len
-            total_out_b64chars += len(b64_full)
-
-            out_map.append({
-                "source": str(rel),
-                "output": str(out_file.relative_to(output_dir)),
-                "orig_bytes": original_len,
-                "final_jpeg_bytes": len(b),
-                "base64_chars": len(b64_full),
-                "data_uri": data_uri,
-            })
-        except Exception as e:
-            skipped += 1
-            log(f"[WARN] {p}: {e}")
+    # items that map to the same output file (a repeated name, or x.jpg next to
+    # x.jpeg): only the last one survives on disk, so only it gets encoded
+    last_for = {_rel(f, input_dir).with_suffix(".b64.txt"): i for i, f in enumerate(files)}
+    if len(last_for) < len(files):
+        keep = set(last_for.values())
+        for i, f in enumerate(files):
+            if i not in keep:
+                skipped += 1
+                log(f"[WARN] {_rel(f, input_dir)}: same output file as a later input; skipped")
+        files = [f for i, f in enumerate(files) if i in keep]
+
+    if cap_chars is not None and PIL_OK and not PIL_SIMD:
+        log("[INFO] Pillow-SIMD not installed; resizing uses Pillow's scalar LANCZOS.")
+
+    # one mkdir per distinct output dir rather than one per file
+    for d in {(output_dir / _rel(f, input_dir)).parent for f in files}:
+        ensure_dir(d)
+    out_map = []
 
-    (output_dir / "manifest.json").write_text(
-        json.dumps(out_map, indent=2),
-        encoding="utf-8"
+    # each file is independent; only capped (decode/encode) batches are CPU-bound
+    # enough to pay for shipping bytes to the shared process pool
+    work = partial(
+        _process_one,
+        input_dir=input_dir,
+        output_dir=output_dir,
+        cap_chars=cap_chars,
+        data_uri=data_uri,
+        max_px=max_px,
+        quality_floor=quality_floor,
     )
+    unique, dup_of = _dedupe(files)
+    rows = {}
+    todo = [files[i] for i in unique]
+    if cap_chars is None or len(todo) == 1:
+        results = map(work, todo)
+    else:
+        results = _pool().map(work, todo, chunksize=4)
+    try:
+        for i, (row, err) in zip(unique, _progress(results, total=len(unique), desc="Encoding")):
+            if err is not None:
+                skipped += 1
+                log(err)
+                continue
+            rows[i] = row
+    except BrokenProcessPool:
+        # a worker died; drop the pool so the next batch starts a fresh one
+        _reset_pool()
+        raise
+
+    # duplicates reuse the first copy's output instead of being re-encoded
+    for i, first in dup_of.items():
+        rel = _rel(files[i], input_dir)
+        if first not in rows:
+            skipped += 1
+            log(f"[WARN] {rel}: identical to {_rel(files[first], input_dir)}, which failed")
+            continue
+        out_rel = rel.with_suffix(".b64.txt")
+        src, dst = output_dir / rows[first]["output"], output_dir / out_rel
+        # same name uploaded twice (or x.jpg/x.jpeg): the output already exists
+        if dst != src:
+            try:
+                shutil.copyfile(src, dst)
+            except OSError as e:
+                skipped += 1
+                log(f"[WARN] {rel}: {e}")
+                continue
+        rows[i] = {**rows[first], "source": str(rel), "output": str(out_rel)}
+
+    for i in sorted(rows):
+        out_map.append(rows[i])
+        total_in += rows[i]["orig_bytes"]
+        total_out_b64chars += rows[i]["base64_chars"]
 
-    if csv_map:
-        import csv
-        with open(output_dir / "manifest.csv", "w", newline="", encoding="utf-8") as f:
-            w = csv.writer(f)
-            w.writerow(["source","output","orig_bytes","final_jpeg_bytes","base64_chars","data_uri"])
-            for row in out_map:
-                w.writerow([
-                    row["source"],
-                    row["output"],
-                    row["orig_bytes"],
-                    row["final_jpeg_bytes"],
-                    row["base64_chars"],
-                    row["data_uri"],
-                ])
+    # the two manifests are independent writes; overlap them
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        pending = [ex.submit(_write_json, output_dir / "manifest.json", out_map)]
+        if csv_map:
+            pending.append(ex.submit(_write_csv, output_dir / "manifest.csv", out_map))
+        for fut in pending:
+            fut.result()
 
     log(f"\nDone. Input bytes: {human(total_in)}  -> Total Base64 chars: {total_out_b64chars:,}")
     if skipped:
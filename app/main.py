@@ -3,17 +3,22 @@ from pydantic import BaseModel
 import shutil
 import tempfile
 import uuid
+import zipfile
 from pathlib import Path
 import os
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Request
-from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
 
 from .core import run_batch  # <- your existing batch logic
 
 import stripe
 from dotenv import load_dotenv
 
+# uvicorn[standard] installs uvloop + httptools (not on Windows) and its default
+# --loop/--http auto picks them. Production:
+#   uvicorn app.main:app --loop uvloop --http httptools --workers N
+
 # Load environment variables from .env (locally)
 load_dotenv()
 
@@ -40,6 +45,52 @@ def read_root():
     return {"status": "ok", "message": "JPG -> Base64 SaaS API"}
 
 
+def unique_upload_names(filenames: list[str]) -> list[str]:
+    # basenames only, and one output file per upload: repeats (including
+    # x.jpg vs x.jpeg, or a/x.jpg vs b/x.jpg) get an index suffix
+    seen = set()
+    names = []
+    for fn in filenames:
+        p = Path(Path(fn).name)
+        stem, n = p.stem, 1
+        while stem.lower() in seen:
+            stem = f"{p.stem}_{n}"
+            n += 1
+        seen.add(stem.lower())
+        names.append(stem + p.suffix)
+    return names
+
+
+class _ZipSink:
+    # write-only target: zipfile sees no tell()/seek() and streams entries
+    # with data descriptors, so bytes can be handed out as they are produced
+    def __init__(self):
+        self.buf = bytearray()
+
+    def write(self, b):
+        self.buf += b
+        return len(b)
+
+    def flush(self):
+        pass
+
+
+def iter_zip(output_dir: Path, cleanup: Path, chunk_size: int = 1 << 20):
+    sink = _ZipSink()
+    try:
+        # base64 text still deflates ~25%; level 1 keeps that cheap
+        with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+            for p in sorted(output_dir.rglob("*")):
+                if p.is_file():
+                    zf.write(p, p.relative_to(output_dir))
+                    if len(sink.buf) >= chunk_size:
+                        yield bytes(sink.buf)
+                        sink.buf.clear()
+        yield bytes(sink.buf)
+    finally:
+        shutil.rmtree(cleanup, ignore_errors=True)
+
+
 # --- TEMP AUTH PLACEHOLDER (everyone allowed for now) ---
 def get_current_user():
     # Later, we'll check a cookie / token tied to Stripe.
@@ -67,26 +118,22 @@ async def convert_images(
                 detail=f"Only JPG/JPEG/PNG files allowed. Invalid: {f.filename}",
             )
 
-    # Temp working directory
+    # Temp working directory (outputs only; uploads stay in memory)
     work_id = str(uuid.uuid4())
     base_tmp = Path(tempfile.gettempdir()) / f"img2b64_{work_id}"
-    input_dir = base_tmp / "input"
     output_dir = base_tmp / "output"
 
     try:
         # Create temp dirs
-        input_dir.mkdir(parents=True, exist_ok=True)
         output_dir.mkdir(parents=True, exist_ok=True)
 
-        # Save uploaded files
-        for f in files:
-            dest = input_dir / f.filename
-            with dest.open("wb") as out:
-                shutil.copyfileobj(f.file, out)
+        # Read uploads straight into memory instead of a disk round-trip
+        names = unique_upload_names([f.filename for f in files])
+        inputs = [(name, await f.read()) for name, f in zip(names, files)]
 
         # Call your existing batch logic
         exit_code = run_batch(
-            input_dir=input_dir,
+            input_dir=None,      # uploads are passed via inputs
             output_dir=output_dir,
             recurse=False,       # we don't need subfolders for uploads
             data_uri=False,      # set True if you want data: prefix
@@ -95,6 +142,7 @@ async def convert_images(
             max_px=800,
             quality_floor=50,
             log=print,           # print to server console for debugging
+            inputs=inputs,
         )
 
         if exit_code != 0:
@@ -103,17 +151,12 @@ async def convert_images(
             shutil.rmtree(base_tmp, ignore_errors=True)
             raise HTTPException(status_code=500, detail="Conversion failed")
 
-        # Zip output_dir
-        zip_base = base_tmp / "result"
-        shutil.make_archive(str(zip_base), "zip", output_dir)
-        zip_path = zip_base.with_suffix(".zip")
-
-        # NOTE: we are not deleting base_tmp here so the file exists
-        # while FileResponse streams it to the client.
-        return FileResponse(
-            path=str(zip_path),
-            filename="converted_base64.zip",
+        # Zip output_dir straight into the response (no result.zip on disk);
+        # the generator removes base_tmp once the last chunk is sent
+        return StreamingResponse(
+            iter_zip(output_dir, cleanup=base_tmp),
             media_type="application/zip",
+            headers={"Content-Disposition": 'attachment; filename="converted_base64.zip"'},
         )
 
     except HTTPException: